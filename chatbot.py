@@ -1,7 +1,13 @@
-import json
+import asyncio
+import hashlib
+import io
 import os
+import ahocorasick
+import httpx
+import orjson
+from collections import OrderedDict
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # Load environment variables
 load_dotenv()
@@ -19,102 +25,183 @@ def load_knowledge_base():
     """Load knowledge base from JSON file"""
     if not os.path.exists("KB.json"):
         return {}
-    with open("KB.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open("KB.json", "rb") as f:
+        return orjson.loads(f.read())
 
-def get_kb_context(query, kb, conversation_history=None):
-    """Retrieve relevant KB information based on query intents (fallback method)."""
-    query = query.lower()
+# Menu category keywords -> KB menu category
+CATEGORY_KEYWORDS = {
+    'appetizer': 'Appetizers & Starters',
+    'starter': 'Appetizers & Starters',
+    'wing': 'Chicken Wings',
+    'calzone': 'Calzones',
+    'pasta': 'Pastas',
+    'kid': 'Kids Meal',
+    'dessert': 'Desserts',
+    'cake': 'Desserts',
+    'drink': 'Beverages & Sides',
+    'beverage': 'Beverages & Sides',
+    'side': 'Beverages & Sides'
+}
+
+# Intent keywords (substring-matched, so 'wing' also catches 'wings')
+RESTAURANT_KW = frozenset({'restaurant', 'location', 'address', 'time', 'open', 'close', 'contact', 'service', 'delivery', 'dine', 'takeaway'})
+PAYMENT_KW = frozenset({'pay', 'card', 'cash', 'money', 'wallet'})
+MENU_KW = frozenset({'menu'})
+PIZZA_KW = frozenset({'pizza', 'ingredient', 'topping', 'king crust', 'contain', 'made of', 'include'})
+DEALS_KW = frozenset({'deal', 'offer', 'promo', 'discount', 'price', 'cost'})
+
+# Intent tag -> keywords that trigger it
+INTENT_KEYWORDS = {
+    'restaurant': RESTAURANT_KW,
+    'payment': PAYMENT_KW,
+    'menu': MENU_KW,
+    'pizza': PIZZA_KW,
+    'category': frozenset(CATEGORY_KEYWORDS),
+    'deals': DEALS_KW,
+}
+
+def build_keyword_automaton():
+    """Build an Aho-Corasick automaton over all intent keywords.
+    Each keyword maps to (keyword, intent tag) so one scan finds every intent."""
+    automaton = ahocorasick.Automaton()
+    for tag, keywords in INTENT_KEYWORDS.items():
+        for kw in keywords:
+            automaton.add_word(kw, (kw, tag))
+    automaton.make_automaton()
+    return automaton
+
+KEYWORD_AUTOMATON = build_keyword_automaton()
+
+# Hits are cached per message under a 16-byte digest of its text, so repeated
+# turns (including long ones) skip the scan without the process retaining them
+MAX_CACHED_MESSAGES = 1024
+_keyword_cache = OrderedDict()
+
+def scan_keywords(text):
+    """Return the (keyword, intent tag) pairs found in text (single linear scan)."""
+    return frozenset(value for _, value in KEYWORD_AUTOMATON.iter(text.lower()))
+
+def match_keywords(text):
+    """Return the (keyword, intent tag) pairs found in a message.
+    Results are cached by digest, so repeated conversation turns cost a hash and a lookup."""
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    hits = _keyword_cache.get(key)
+    if hits is None:
+        hits = scan_keywords(text)
+        _keyword_cache[key] = hits
+        if len(_keyword_cache) > MAX_CACHED_MESSAGES:
+            _keyword_cache.popitem(last=False)
+    else:
+        _keyword_cache.move_to_end(key)
+    return hits
+
+def render_kb_blocks(kb):
+    """Render every KB section once; the KB is static for the process lifetime.
+    Returns a dict of intent tag / menu category -> rendered text block."""
+    r = kb.get('restaurant', {})
+    menu = kb.get('menu', {})
+    blocks = {
+        'restaurant': f"Restaurant: {r.get('name')} ({r.get('country')})\nServices: {', '.join(r.get('services', []))}",
+        'payment': f"Payment Methods: {', '.join(kb.get('payment_methods', []))}",
+        'menu': f"Available Menu Categories: {', '.join(menu.keys())}",
+    }
+    
+    # Pizza
+    buf = io.StringIO()
+    buf.write("=== PIZZA MENU ===\n")
+    for subcat, items in menu.get('Pizza', {}).items():
+        buf.write(f"[{subcat}]\n")
+        for item in items:
+            buf.write(f"- {item['name']}: {item['description']}\n")
+    blocks['pizza'] = buf.getvalue()[:-1]
+    
+    # Other categories
+    for cat_key in set(CATEGORY_KEYWORDS.values()):
+        items = menu.get(cat_key, [])
+        buf = io.StringIO()
+        buf.write(f"\n[{cat_key}]\n")
+        if isinstance(items, list):
+            if items and isinstance(items[0], dict):
+                for item in items:
+                    buf.write(f"- {item['name']}: {item['description']}\n")
+            else:
+                for item in items:
+                    buf.write(f"- {item}\n")
+        blocks[cat_key] = buf.getvalue()[:-1]
+    
+    # Deals
+    buf = io.StringIO()
+    buf.write("\n=== DEALS & OFFERS ===\n")
+    for cat, items in kb.get('deals', {}).items():
+        buf.write(f"[{cat}]\n")
+        for item in items:
+            if isinstance(item, dict):
+                name = item.get('name', '')
+                desc = item.get('description', '')
+                if name: buf.write(f"- {name}: {desc}\n")
+                else: buf.write(f"- {desc}\n")
+            else: # fallback
+                buf.write(f"- {item}\n")
+    blocks['deals'] = buf.getvalue()[:-1]
     
-    # Extract context from conversation history if available
-    history_text = ""
+    return blocks
+
+def get_kb_context(query, kb, conversation_history=None, kb_blocks=None, known_hits=()):
+    """Retrieve relevant KB information based on query intents (fallback method).
+    known_hits are keyword hits already computed for messages left out of conversation_history."""
+    # Match the query together with conversation history for better context;
+    # previously seen messages hit the cache instead of being rescanned
+    hits = set(match_keywords(query))
+    hits.update(known_hits)
     if conversation_history:
         for msg in conversation_history:
             if msg.get('role') in ['user', 'assistant', 'system']:
-                history_text += " " + msg.get('content', '').lower()
+                hits |= match_keywords(msg.get('content', ''))
     
-    # Combine query with history for better context matching
-    combined_query = query + " " + history_text
     context = []
+    matched = {kw for kw, _ in hits}
+    intents = {tag for _, tag in hits}
     
-    # 1. Restaurant Info & Services
-    if any(x in combined_query for x in ['restaurant', 'location', 'address', 'time', 'open', 'close', 'contact', 'service', 'delivery', 'dine', 'takeaway']):
-        r = kb.get('restaurant', {})
-        context.append(f"Restaurant: {r.get('name')} ({r.get('country')})")
-        context.append(f"Services: {', '.join(r.get('services', []))}")
-        
-    # 2. Payment
-    if any(x in combined_query for x in ['pay', 'card', 'cash', 'money', 'wallet']):
-        context.append(f"Payment Methods: {', '.join(kb.get('payment_methods', []))}")
-        
-    # 3. Menu Categories
-    menu = kb.get('menu', {})
+    # Sections are pre-rendered; just pick the ones flagged by intent detection
+    if kb_blocks is None:
+        kb_blocks = render_kb_blocks(kb)
     
-    # Generic 'menu' query - show categories
-    if 'menu' in combined_query:
-        cats = list(menu.keys())
-        context.append(f"Available Menu Categories: {', '.join(cats)}")
-        
-    # Specific categories
-    # Pizza - check both current query and history
-    if any(x in combined_query for x in ['pizza', 'ingredient', 'topping', 'king crust', 'contain', 'made of', 'include']):
-        context.append("=== PIZZA MENU ===")
-        for subcat, items in menu.get('Pizza', {}).items():
-            context.append(f"[{subcat}]")
-            for item in items:
-                context.append(f"- {item['name']}: {item['description']}")
+    # 1. Restaurant Info & Services, 2. Payment, 3. Menu Categories, Pizza
+    for tag in ('restaurant', 'payment', 'menu', 'pizza'):
+        if tag in intents:
+            context.append(kb_blocks[tag])
                 
     # Other categories mapping
-    cat_keywords = {
-        'appetizer': 'Appetizers & Starters',
-        'starter': 'Appetizers & Starters',
-        'wing': 'Chicken Wings',
-        'calzone': 'Calzones',
-        'pasta': 'Pastas',
-        'kid': 'Kids Meal',
-        'dessert': 'Desserts',
-        'cake': 'Desserts',
-        'drink': 'Beverages & Sides',
-        'beverage': 'Beverages & Sides',
-        'side': 'Beverages & Sides'
-    }
-    
-    for kw, cat_key in cat_keywords.items():
-        if kw in combined_query:
-            items = menu.get(cat_key, [])
-            context.append(f"\n[{cat_key}]")
-            if isinstance(items, list):
-                if items and isinstance(items[0], dict):
-                    for item in items:
-                        context.append(f"- {item['name']}: {item['description']}")
-                else:
-                    for item in items:
-                        context.append(f"- {item}")
+    for kw, cat_key in CATEGORY_KEYWORDS.items():
+        if kw in matched:
+            context.append(kb_blocks[cat_key])
                         
     # 4. Deals
-    if any(x in combined_query for x in ['deal', 'offer', 'promo', 'discount', 'price', 'cost']):
-        context.append("\n=== DEALS & OFFERS ===")
-        deals = kb.get('deals', {})
-        for cat, items in deals.items():
-            context.append(f"[{cat}]")
-            for item in items:
-                if isinstance(item, dict):
-                    name = item.get('name', '')
-                    desc = item.get('description', '')
-                    if name: context.append(f"- {name}: {desc}")
-                    else: context.append(f"- {desc}")
-                else: # fallback
-                    context.append(f"- {item}")
+    if 'deals' in intents:
+        context.append(kb_blocks['deals'])
 
     return "\n".join(context)
 
+def build_messages(static_system, summary=None, committed=()):
+    """Assemble a prompt as [static system prompt] -> [rolling summary] -> [committed history].
+    Ordered from most to least stable so the shared prefix stays byte-identical for
+    provider-side prompt caching; the summary only changes when older turns are folded in.
+    generate_response appends the latest user message (with KB context) last."""
+    messages = [{"role": "system", "content": static_system}]
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    messages.extend(committed)
+    return messages
+
 class ChatBotService:
     def __init__(self):
         self.client = None
         self.system_prompt = None
         self.kb = None
+        self.kb_blocks = {}
         self.restaurant_name = "Alchemy Pizza"
         self.full_system_prompt = ""
+        self.system_prompt_hits = frozenset()
         # self.model = "qwen/qwen3-4b:free" # Current valid Qwen3 free endpoint (Jan 2026)
         # self.model = "Qwen/Qwen2.5-0.5B-Instruct" # Current valid Qwen3 free endpoint (Jan 2026)
         self.model = "models/gemini-2.5-flash" # Latest Gemini model
@@ -132,9 +219,17 @@ class ChatBotService:
         if not api_key:
             print("Warning: GEMINI_API_KEY not found in environment.")
         
-        self.client = OpenAI(
+        # Async client over HTTP/2 so concurrent streams share one connection.
+        # Idle connections are kept for 5 minutes (httpx default is 5s) so the
+        # warmed-up connection survives quiet periods between chats.
+        self.client = AsyncOpenAI(
             base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
             api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(30, connect=5),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=300),
+            ),
         )
         
         # Load config
@@ -142,6 +237,7 @@ class ChatBotService:
             self.system_prompt = load_system_prompt()
             self.summary_prompt = self.load_summary_prompt()
             self.kb = load_knowledge_base()
+            self.kb_blocks = render_kb_blocks(self.kb)
             self.restaurant_name = self.kb.get("restaurant", {}).get("name", "Alchemy Pizza")
             
             self.full_system_prompt = f"""{self.system_prompt}
@@ -152,18 +248,39 @@ class ChatBotService:
             Use this information to assist the customer.
             Be concise and friendly.
             """
+            # The system prompt leads every conversation; scan it once here
+            self.system_prompt_hits = scan_keywords(self.full_system_prompt)
             
             print("✅ Config loaded successfully.")
         except Exception as e:
             print(f"❌ Error loading config files: {e}")
             raise e
 
-    def generate_response(self, user_input, conversation_history=None):
+    async def warmup(self):
+        """Open the connection to the Gemini endpoint before the first chat request"""
+        try:
+            # Best effort: one short attempt so an unreachable endpoint can't stall startup
+            await self.client.with_options(max_retries=0, timeout=5).models.list()
+            print("✅ Gemini connection warmed up.")
+        except Exception as e:
+            print(f"Warning: Gemini warm-up request failed: {e}")
+
+    async def close(self):
+        """Close the underlying HTTP client"""
+        if self.client is not None:
+            await self.client.close()
+
+    async def generate_response(self, user_input, conversation_history=None):
         if conversation_history is None:
             conversation_history = [{"role": "system", "content": self.full_system_prompt}]
         
-        # Context Retrieval - pass conversation history for better context
-        kb_context = get_kb_context(user_input, self.kb, conversation_history)
+        # Context Retrieval - pass conversation history for better context,
+        # reusing the precomputed hits when it opens with our system prompt
+        history_to_scan, known_hits = conversation_history, ()
+        if conversation_history and conversation_history[0].get('role') == 'system' \
+                and conversation_history[0].get('content') == self.full_system_prompt:
+            history_to_scan, known_hits = conversation_history[1:], self.system_prompt_hits
+        kb_context = get_kb_context(user_input, self.kb, history_to_scan, self.kb_blocks, known_hits)
             
         full_input = user_input
         if kb_context:
@@ -172,27 +289,21 @@ class ChatBotService:
         conversation_history.append({"role": "user", "content": full_input})
         
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=conversation_history,
                 stream=True,
                 max_tokens=500, # Explicitly limit output tokens
             )
             
-            response_text = ""
-            for chunk in response:
+            async for chunk in response:
                 if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    response_text += content
-                    yield content
-            
-            return response_text
+                    yield chunk.choices[0].delta.content
         except Exception as e:
             print(f"Error calling Gemini: {e}")
             yield f"I'm sorry, I'm having trouble connecting right now. Error: {str(e)}"
-            return f"Error: {str(e)}"
 
-    def summarize_conversation(self, last_summary, new_interaction):
+    async def summarize_conversation(self, last_summary, new_interaction):
         """Summarize the conversation to keep context small."""
         
         prompt = f"""
@@ -206,7 +317,7 @@ class ChatBotService:
         """
         
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=[
                     {"role": "system", "content": self.summary_prompt},
@@ -231,7 +342,7 @@ class ChatBotService:
             # otherwise we hit rate limits with massive payloads.
             return f"{last_summary}\n[Unsummarized Interaction]".strip()
 
-def chat():
+async def chat():
     bot = ChatBotService()
     bot.initialize()
     
@@ -240,7 +351,9 @@ def chat():
     print("="*50)
     print("Type 'quit' to exit.\n")
     
-    messages = [{"role": "system", "content": bot.full_system_prompt}]
+    history = [] # Committed user/assistant turns
+    transcript = [] # Same turns without KB context, used for summaries
+    rolling_summary = ""
     
     while True:
         try:
@@ -255,18 +368,31 @@ def chat():
         print("Daniel Siddiqui: ", end="", flush=True)
         
         # Generate and stream response
+        summary = f"Conversation so far: {rolling_summary}" if rolling_summary else None
+        messages = build_messages(bot.full_system_prompt, summary, history)
         generator = bot.generate_response(user_input, messages)
-        full_response = ""
-        for token in generator:
+        tokens = []
+        async for token in generator:
             print(token, end="", flush=True)
-            full_response += token
+            tokens.append(token)
         print()
+        full_response = "".join(tokens)
         
-        # Add assistant response to history
-        messages.append({"role": "assistant", "content": full_response})
+        # Commit the user turn (as sent, with KB context) and the assistant response
+        history.append(messages[-1])
+        history.append({"role": "assistant", "content": full_response})
+        transcript.append(f"User: {user_input}")
+        transcript.append(f"Assistant: {full_response}")
         
-        if len(messages) > 10: # Increased history limit as API can handle it better
-            messages = [messages[0]] + messages[-9:]
+        if len(history) > 9: # Increased history limit as API can handle it better
+            # Fold older turns into a rolling summary instead of dropping them,
+            # keeping the prompt bounded to system + summary + last 4 messages
+            older = "\n".join(transcript[:-4])
+            rolling_summary = await bot.summarize_conversation(rolling_summary, older)
+            history = history[-4:]
+            transcript = transcript[-4:]
+    
+    await bot.close()
 
 if __name__ == "__main__":
-    chat()
+    asyncio.run(chat())
@@ -1,9 +1,12 @@
+import traceback
+import orjson
 from fastapi import FastAPI, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from chatbot import ChatBotService
+from chatbot import ChatBotService, build_messages
 import uvicorn
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 
 # Define Pydantic models for request and response
 class Message(BaseModel):
@@ -18,6 +21,9 @@ class ChatResponse(BaseModel):
     response: str
     history: List[Message]
 
+# Raw messages kept verbatim for generation when switching to summary mode
+HISTORY_WINDOW = 6
+
 # Global bot instance
 bot = ChatBotService()
 
@@ -30,6 +36,8 @@ async def lifespan(app: FastAPI):
     print("Initializing ChatBot Service...")
     try:
         bot.initialize()
+        # Pay the TLS/HTTP2 handshake here rather than on the first /chat call
+        await bot.warmup()
         print("ChatBot Service Initialized successfully.")
     except Exception as e:
         print(f"Failed to initialize ChatBot Service: {e}")
@@ -40,6 +48,7 @@ async def lifespan(app: FastAPI):
     
     # Cleanup
     print("Shutting down ChatBot Service...")
+    await bot.close()
     print("ChatBot Service Shutdown complete.")
 
 app = FastAPI(
@@ -59,100 +68,142 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def run_chat(request: ChatRequest):
     """
-    Chat endpoint to interact with the bot.
-    Accepts a user message and optional conversation history.
-    Returns the bot's response and the updated conversation history.
+    Runs a single chat turn.
+    Yields response tokens as they stream in, then the final ChatResponse
+    carrying the updated conversation history.
     """
-    try:
-        # Convert Pydantic models to dicts
-        input_history = [msg.model_dump() for msg in request.history] if request.history else []
+    # Plain dicts for the LLM; attribute access avoids a model_dump() per message
+    input_history = [{"role": m.role, "content": m.content} for m in request.history or []]
+    
+    # Check for Summary Mode (if we have a system message in history that isn't the persona)
+    # Note: Frontend history generally doesn't contain the 'system' persona unless we sent it.
+    # Our Logic: If history has a role='system', it's a summary we sent previously.
+    is_summary_mode = any(msg['role'] == 'system' for msg in input_history)
+    
+    tokens = []  # joined once at the end; repeated str += is quadratic
+    new_history_objs = []
+    
+    if is_summary_mode:
+        # --- SUMMARY MODE ---
+        current_summary = next((m['content'] for m in input_history if m['role'] == 'system'), "")
         
-        # Check for Summary Mode (if we have a system message in history that isn't the persona)
-        # Note: Frontend history generally doesn't contain the 'system' persona unless we sent it.
-        # Our Logic: If history has a role='system', it's a summary we sent previously.
-        is_summary_mode = any(msg['role'] == 'system' for msg in input_history)
+        # Prepare generation context (summary goes after the stable prefix)
+        summary = f"Previous Conversation Summary: {current_summary}" if current_summary else None
+        generation_history = build_messages(bot.full_system_prompt, summary)
         
-        full_response = ""
-        new_history_objs = []
+        # Generate Response
+        response_generator = bot.generate_response(request.message, generation_history)
+        async for token in response_generator:
+            tokens.append(token)
+            yield token
+        full_response = "".join(tokens)
+        # Update Summary
+        new_interaction = f"User: {request.message}\nAssistant: {full_response}"
+        new_summary = await bot.summarize_conversation(current_summary, new_interaction)
         
-        if is_summary_mode:
-            # --- SUMMARY MODE ---
-            current_summary = next((m['content'] for m in input_history if m['role'] == 'system'), "")
+        new_history_objs = [Message.model_construct(role="system", content=new_summary)]
+        
+    else:   
+        # --- RAW MODE ---
+        # Check if we should switch to summary mode
+        # Threshold: 4 messages (2 user turns + 2 assistant responses)
+        if len(input_history) >= 4:
+            # --- SWITCH TO SUMMARY MODE ---
+            print("Switching to Summary Mode...")
             
-            # Prepare generation context
-            generation_history = [{"role": "system", "content": bot.full_system_prompt}]
-            if current_summary:
-                generation_history.append({"role": "system", "content": f"Previous Conversation Summary: {current_summary}"})
+            # 1. Generate Response from a sliding window of the raw history,
+            # so no summarization call sits in front of the first token
+            generation_history = build_messages(bot.full_system_prompt, committed=input_history[-HISTORY_WINDOW:])
             
-            # Generate Response
             response_generator = bot.generate_response(request.message, generation_history)
-            for token in response_generator:
-                full_response += token
-            # Update Summary
-            new_interaction = f"User: {request.message}\nAssistant: {full_response}"
-            new_summary = bot.summarize_conversation(current_summary, new_interaction)
+            async for token in response_generator:
+                tokens.append(token)
+                yield token
+            full_response = "".join(tokens)
+            
+            # 2. Summarize raw history + new interaction in a single pass
+            # We concat the raw messages to form a "previous interaction" block
+            raw_text = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in input_history])
+            new_interaction = f"{raw_text}\nUser: {request.message}\nAssistant: {full_response}"
+            final_summary = await bot.summarize_conversation("", new_interaction)
+            
+            new_history_objs = [Message.model_construct(role="system", content=final_summary)]
+            
+        else:
+            # --- STAY IN RAW MODE ---
+            
+            # Prepare generation context: System Prompt + Raw History
+            generation_history = build_messages(bot.full_system_prompt, committed=input_history)
             
-            new_history_objs = [Message(role="system", content=new_summary)]
+            # Generate Response
+            # Note: generate_response appends the new user message to conversation_history internally
+            response_generator = bot.generate_response(request.message, generation_history)
+            async for token in response_generator:
+                tokens.append(token)
+                yield token
+            full_response = "".join(tokens)
             
-        else:   
-            # --- RAW MODE ---
-            # Check if we should switch to summary mode
-            # Threshold: 4 messages (2 user turns + 2 assistant responses)
-            if len(input_history) >= 4:
-                # --- SWITCH TO SUMMARY MODE ---
-                print("Switching to Summary Mode...")
-                
-                # 1. Summarize existing raw history
-                # We concat the raw messages to form a "previous interaction" block
-                raw_text = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in input_history])
-                initial_summary = bot.summarize_conversation("", raw_text)
-                
-                # 2. Generate Response using this summary
-                generation_history = [{"role": "system", "content": bot.full_system_prompt}]
-                generation_history.append({"role": "system", "content": f"Previous Conversation Summary: {initial_summary}"})
-                
-                response_generator = bot.generate_response(request.message, generation_history)
-                for token in response_generator:
-                    full_response += token
-                
-                # 3. Create Final Summary
-                new_interaction = f"User: {request.message}\nAssistant: {full_response}"
-                final_summary = bot.summarize_conversation(initial_summary, new_interaction)
-                
-                new_history_objs = [Message(role="system", content=final_summary)]
-                
-            else:
-                # --- STAY IN RAW MODE ---
-                
-                # Prepare generation context: System Prompt + Raw History
-                generation_history = [{"role": "system", "content": bot.full_system_prompt}]
-                generation_history.extend(input_history)
-                
-                # Generate Response
-                # Note: generate_response appends the new user message to conversation_history internally
-                response_generator = bot.generate_response(request.message, generation_history)
-                for token in response_generator:
-                    full_response += token
-                
-                # Return updated raw history
-                # We need to take the input history + new user msg + new asst msg
-                new_history_objs = [Message(**m) for m in input_history]
-                new_history_objs.append(Message(role="user", content=request.message))
-                new_history_objs.append(Message(role="assistant", content=full_response))
-
-        return ChatResponse(
-            response=full_response,
-            history=new_history_objs
-        )
+            # Return updated raw history
+            # We need to take the input history + new user msg + new asst msg
+            new_history_objs = [Message.model_construct(**m) for m in input_history]
+            new_history_objs.append(Message.model_construct(role="user", content=request.message))
+            new_history_objs.append(Message.model_construct(role="assistant", content=full_response))
+
+    # Built from trusted data, so skip re-validation
+    yield ChatResponse.model_construct(
+        response=full_response,
+        history=new_history_objs
+    )
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(request: ChatRequest):
+    """
+    Chat endpoint to interact with the bot.
+    Accepts a user message and optional conversation history.
+    Returns the bot's response and the updated conversation history.
+    """
+    try:
+        # aclosing: finalize the generator right away when we return early
+        async with aclosing(run_chat(request)) as events:
+            async for event in events:
+                if isinstance(event, ChatResponse):
+                    return event
+        raise RuntimeError("Chat turn ended without a final response")
 
     except Exception as e:
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Streaming chat endpoint (Server-Sent Events).
+    Emits one `data: {"token": ...}` event per generated token, followed by
+    a final `data: {"done": true, "response": ..., "history": [...]}` event.
+    On failure a `data: {"error": ...}` event is sent instead of the final one.
+    """
+    async def event_stream():
+        try:
+            done = False
+            async with aclosing(run_chat(request)) as events:
+                async for event in events:
+                    if isinstance(event, ChatResponse):
+                        done = True
+                        payload = {"done": True, **event.model_dump()}
+                    else:
+                        payload = {"token": event}
+                    # orjson encodes straight to bytes; this runs once per token
+                    yield b"data: " + orjson.dumps(payload) + b"\n\n"
+            if not done:
+                raise RuntimeError("Chat turn ended without a final response")
+        except Exception as e:
+            traceback.print_exc()
+            yield b"data: " + orjson.dumps({"error": str(e)}) + b"\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/health")
 def health_check():
     """Health check endpoint."""
@@ -161,4 +212,15 @@ def health_check():
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 7860))  # Default to 7860 for HF Spaces
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    reload = os.environ.get("RELOAD") == "1"  # Auto-reload for local development only
+    limit_concurrency = os.environ.get("LIMIT_CONCURRENCY")  # Cap concurrent connections per worker
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="auto",  # uvloop when installed, asyncio otherwise
+        http="auto",  # httptools when installed, h11 otherwise
+        workers=None if reload else int(os.environ.get("WEB_CONCURRENCY", 1)),
+        limit_concurrency=int(limit_concurrency) if limit_concurrency else None,
+        reload=reload,
+    )